@@ -4,6 +4,11 @@ from fpdf import FPDF
 from datetime import datetime
 import os
 import time
+import hashlib
+import json
+import tempfile
+from bisect import bisect_right
+from math import gcd
 
 # ==========================================
 # ⚙️ PAGE & THEME CONFIGURATION
@@ -272,6 +277,120 @@ def run_waterfall_allocation(df, total_income):
     df_sorted['Available_Income_Snapshot'] = snaps
     return df_sorted
 
+# ==========================================
+# 🧩 APPROVAL-SET OPTIMIZER
+# ==========================================
+# Every loan in a subset clears the waterfall exactly when the subset's combined
+# income requirement (Obligation x Required Multiplier) fits within income, so
+# picking the approvable subset is a 0/1 knapsack: exposure is the value and
+# required income is the weight.
+MAX_EXPOSURE_DP_STATES = 25000
+MAX_SEARCH_NODES = 100000
+# The waterfall checks coverage by sequential subtraction and division, which can
+# round differently from a plain sum; keep this much relative income in reserve.
+CAPACITY_TOLERANCE = 1e-9
+
+def knapsack_by_exposure(values, weights, capacity):
+    """Exact DP over exposure units (min required income per exposure level).
+    Returns the chosen indices, or None when the exposure grid is too large."""
+    if any(v != int(v) for v in values): return None
+    units = [int(v) for v in values]
+    step = 0
+    for u in units: step = gcd(step, u)
+    if step == 0: return []
+    units = [u // step for u in units]
+    total = sum(units)
+    if total > MAX_EXPOSURE_DP_STATES: return None
+
+    min_req = [0.0] + [float('inf')] * total
+    took = []
+    for u, w in zip(units, weights):
+        shifted = [prev + w for prev in min_req[:-u]]
+        better = [s < cur for s, cur in zip(shifted, min_req[u:])]
+        min_req[u:] = [s if b else cur for s, cur, b in zip(shifted, min_req[u:], better)]
+        took.append(better)
+
+    level = max(v for v in range(total + 1) if min_req[v] <= capacity)
+    chosen = []
+    for k in range(len(units) - 1, -1, -1):
+        if level >= units[k] and took[k][level - units[k]]:
+            chosen.append(k)
+            level -= units[k]
+    return chosen
+
+def knapsack_branch_and_bound(values, weights, capacity):
+    """Depth-first search in value-density order, pruned by the fractional (LP) bound.
+    Stops after MAX_SEARCH_NODES and keeps the best subset found so far.
+    Returns (chosen indices, whether the search finished and so proved optimality)."""
+    order = sorted(range(len(values)), key=lambda i: values[i] / weights[i], reverse=True)
+    vals = [values[i] for i in order]
+    wts = [weights[i] for i in order]
+    n = len(order)
+    pre_w, pre_v = [0.0], [0.0]
+    for v, w in zip(vals, wts):
+        pre_w.append(pre_w[-1] + w)
+        pre_v.append(pre_v[-1] + v)
+
+    def upper_bound(i, cap):
+        k = bisect_right(pre_w, pre_w[i] + cap, lo=i) - 1
+        bound = pre_v[k] - pre_v[i]
+        if k < n:
+            # Martello-Toth: the critical item is either left out or forced in
+            left = cap - (pre_w[k] - pre_w[i])
+            without = left * vals[k + 1] / wts[k + 1] if k + 1 < n else 0.0
+            forced = vals[k] - (wts[k] - left) * vals[k - 1] / wts[k - 1] if k > i else 0.0
+            bound += max(without, forced)
+        return bound
+
+    best_val, best_set, picked = 0.0, [], []
+    nodes_left = MAX_SEARCH_NODES
+
+    def search(i, cap, val):
+        nonlocal best_val, best_set, nodes_left
+        nodes_left -= 1
+        if val > best_val:
+            best_val, best_set = val, list(picked)
+        if i == n or nodes_left <= 0 or val + upper_bound(i, cap) <= best_val: return
+        if wts[i] <= cap:
+            picked.append(i)
+            search(i + 1, cap - wts[i], val + vals[i])
+            picked.pop()
+        # Skipping facility i only pays off if the rest can use up the room it leaves
+        if pre_w[n] - pre_w[i + 1] >= cap - wts[i]:
+            search(i + 1, cap, val)
+
+    search(0, capacity, 0.0)
+    return [order[i] for i in best_set], nodes_left > 0
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def optimize_approval_set(df, total_income):
+    """Finds the subset of facilities with the largest exposure in which every loan passes
+    the priority waterfall. Returns (waterfall result for that subset, aggregate coverage,
+    is_optimal); is_optimal is False when the search limit was hit and the subset is only
+    the best one found."""
+    req_income = (df['Obligation'] * df['Required Multiplier']).tolist()
+    amounts = df['Amount'].tolist()
+    obligations = df['Obligation'].tolist()
+    cand = [i for i in range(len(df)) if amounts[i] > 0 and obligations[i] > 0 and req_income[i] <= total_income]
+    values = [float(amounts[i]) for i in cand]
+    weights = [float(req_income[i]) for i in cand]
+
+    capacity = total_income * (1.0 - CAPACITY_TOLERANCE)
+    chosen = knapsack_by_exposure(values, weights, capacity)
+    is_optimal = True
+    if chosen is None:
+        chosen, is_optimal = knapsack_branch_and_bound(values, weights, capacity)
+
+    subset = df.iloc[sorted(cand[k] for k in chosen)]
+    opt_res = run_waterfall_allocation(subset, total_income)
+    # Safety net: never present a failing loan as approvable
+    while not opt_res['Pass_Status'].all():
+        opt_res = run_waterfall_allocation(opt_res[opt_res['Pass_Status']], total_income)
+        is_optimal = False
+    opt_obl = opt_res['Obligation'].sum()
+    opt_agg = total_income / opt_obl if opt_obl > 0 else 0
+    return opt_res, opt_agg, is_optimal
+
 # ==========================================
 # 📄 ENTERPRISE PDF ENGINE
 # ==========================================
@@ -396,12 +515,132 @@ def generate_pdf(client, income, df_main_results, is_pass, exposure, shortfall,
     
     return pdf.output(dest='S').encode('latin-1')
 
+# ==========================================
+# 💾 REPORT DISK CACHE
+# ==========================================
+# Generated PDFs live on disk keyed by a hash of their inputs; session state only
+# keeps the key, so server memory no longer grows with every analyst's reports.
+# Reports contain client data, so the cache is private to the app's user (0o700 / 0o600).
+# A report's mtime is refreshed only when it is generated or downloaded, and it
+# expires PDF_CACHE_TTL_SECONDS after that.
+PDF_CACHE_DIR = os.environ.get(
+    "DTI_PDF_CACHE_DIR",
+    os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "dti", "pdf_reports")
+)
+PDF_CACHE_TTL_SECONDS = 6 * 3600
+PDF_CACHE_MAX_BYTES = 200 * 1024 * 1024
+PDF_TMP_GRACE_SECONDS = 300  # Older *.tmp files are orphans of failed writes
+PDF_CACHE_EVICT_INTERVAL_SECONDS = 300
+
+def pdf_cache_key(*inputs):
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def pdf_cache_path(key):
+    return os.path.join(PDF_CACHE_DIR, f"{key}.pdf")
+
+def get_cached_pdf(key):
+    """Returns the cached file path for key, or None if it is missing or expired."""
+    path = pdf_cache_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > PDF_CACHE_TTL_SECONDS: return None
+    except OSError:
+        return None
+    return path
+
+def refresh_cached_pdf(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass  # Evicted in the meantime; the next lookup reports it as expired
+
+def read_cached_pdf(key):
+    """Loads a cached report for download and refreshes its recency, or None if it is gone."""
+    path = get_cached_pdf(key)
+    if path is None: return None
+    try:
+        with open(path, 'rb') as f:
+            pdf_bytes = f.read()
+    except OSError:
+        return None
+    refresh_cached_pdf(path)
+    return pdf_bytes
+
+def store_pdf(key, pdf_bytes):
+    # Only a directory created here is made private; an operator-supplied one keeps its permissions
+    if not os.path.isdir(PDF_CACHE_DIR):
+        os.makedirs(PDF_CACHE_DIR, mode=0o700, exist_ok=True)
+    path = pdf_cache_path(key)
+    # Sessions are threads of one process, so each write needs its own temp file (mkstemp creates it 0o600)
+    fd, tmp_path = tempfile.mkstemp(dir=PDF_CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    evict_pdf_cache()
+    return path
+
+def evict_pdf_cache():
+    """Drops expired reports, then the least recently used ones until under the size cap."""
+    now = time.time()
+    entries = []
+    try:
+        names = os.listdir(PDF_CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(PDF_CACHE_DIR, name)
+        try:
+            if name.endswith('.tmp'):
+                if now - os.path.getmtime(path) > PDF_TMP_GRACE_SECONDS: os.remove(path)
+                continue
+            if not name.endswith('.pdf'): continue
+            st_info = os.stat(path)
+            if now - st_info.st_mtime > PDF_CACHE_TTL_SECONDS:
+                os.remove(path)
+            else:
+                entries.append((st_info.st_mtime, st_info.st_size, path))
+        except OSError:
+            continue  # Removed by another session in the meantime
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= PDF_CACHE_MAX_BYTES: break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def maybe_evict_pdf_cache():
+    """Runs eviction at most once per interval across all sessions, so expired reports
+    are removed even when nobody generates a new one."""
+    marker = os.path.join(PDF_CACHE_DIR, '.last_eviction')
+    try:
+        if time.time() - os.path.getmtime(marker) < PDF_CACHE_EVICT_INTERVAL_SECONDS: return
+    except OSError:
+        pass  # No marker yet
+    try:
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+    except OSError:
+        return  # Cache directory missing or not writable, so there is nothing to evict
+    evict_pdf_cache()
+
 # ==========================================
 # 🏠 APP LOGIC
 # ==========================================
 if 'loans' not in st.session_state: st.session_state.loans = []
 if 'income_sources' not in st.session_state: st.session_state.income_sources = [] 
 if 'custom_scenarios' not in st.session_state: st.session_state.custom_scenarios = []
+maybe_evict_pdf_cache()
 
 # --- SIDEBAR CONFIGURATION ---
 with st.sidebar:
@@ -653,6 +892,19 @@ if st.session_state.loans:
     else:
         render_facility_table(df_result, caption_text=f"Scenario: {scenario_name}")
 
+    if not overall_pass:
+        with st.expander("🧩 Approvable Subset Optimizer", expanded=False):
+            st.markdown("Largest-exposure combination of requested facilities where every loan passes the priority allocation.")
+            opt_res, opt_agg, opt_is_optimal = optimize_approval_set(df, eff_income)
+            if opt_res.empty:
+                st.warning("No requested facility can be approved at the current income level.")
+            else:
+                if not opt_is_optimal:
+                    st.caption("Search limit reached: showing the best combination found, which may fall slightly short of the maximum exposure.")
+                opt_exposure = opt_res['Amount'].sum()
+                st.info(f"Approvable Exposure: Rs.{opt_exposure:,.0f} of Rs.{tot_prin:,.0f} ({len(opt_res)} of {len(df)} facilities)")
+                render_facility_table(opt_res, caption_text=f"Approvable Facilities (Aggregate Coverage: {opt_agg:.2f}x)")
+
     with st.expander("📄 Generate Comprehensive Report", expanded=True):
         st.markdown("Export a detailed PDF report with executive summary and scenario analysis.")
         ec1, ec2 = st.columns([3, 1])
@@ -663,28 +915,68 @@ if st.session_state.loans:
                 if not report_name:
                     st.error("⚠️ Please enter a client name first.")
                 else:
+                    uncached_pdf = None
                     with st.spinner("Processing document..."):
                         sources_for_pdf = stressed_sources_selection if (inc_mode == "Multiple Sources" and enable_stress) else None
-                        pdf_bytes = generate_pdf(
-                            report_name, gross_income, df_result, overall_pass, tot_prin, income_shortfall,
+                        # The report prints today's date, so it is part of the key
+                        pdf_key = pdf_cache_key(
+                            report_name, gross_income, df_result.to_dict('records'), overall_pass, tot_prin, income_shortfall,
                             mode_label, scenario_name, stress_rate_val, stress_inc_val,
-                            st.session_state.loans, matrix_data, agg_dti, sources_for_pdf
+                            st.session_state.loans, matrix_data, agg_dti, sources_for_pdf, datetime.now().strftime('%Y%m%d')
                         )
-                        st.session_state['generated_pdf'] = pdf_bytes
-                        st.session_state['generated_pdf_name'] = f"Report_{report_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.pdf"
+                        pdf_name = f"Report_{report_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.pdf"
+                        cached_path = get_cached_pdf(pdf_key)
+                        if cached_path is not None:
+                            refresh_cached_pdf(cached_path)
+                        else:
+                            pdf_bytes = generate_pdf(
+                                report_name, gross_income, df_result, overall_pass, tot_prin, income_shortfall,
+                                mode_label, scenario_name, stress_rate_val, stress_inc_val,
+                                st.session_state.loans, matrix_data, agg_dti, sources_for_pdf
+                            )
+                            try:
+                                store_pdf(pdf_key, pdf_bytes)
+                            except OSError:
+                                uncached_pdf = pdf_bytes
+                    if uncached_pdf is not None:
+                        # Report cache unavailable: offer this run's bytes directly instead of failing
+                        st.session_state.pop('generated_pdf_key', None)
+                        st.warning("⚠️ Report cache is unavailable; download the report now, it will not be kept.")
+                        st.download_button(
+                            label="⬇️ Download PDF Now",
+                            data=uncached_pdf,
+                            file_name=pdf_name,
+                            mime="application/pdf",
+                            type="secondary",
+                            use_container_width=True
+                        )
+                    else:
+                        st.session_state['generated_pdf_key'] = pdf_key
+                        st.session_state['generated_pdf_name'] = pdf_name
                         st.rerun()
 
-        if 'generated_pdf' in st.session_state:
+        if 'generated_pdf_key' in st.session_state:
             st.markdown("---")
-            st.success("✅ Report generated successfully.")
-            st.download_button(
-                label="⬇️ Download PDF Now",
-                data=st.session_state['generated_pdf'],
-                file_name=st.session_state['generated_pdf_name'],
-                mime="application/pdf",
-                type="secondary",
-                use_container_width=True
-            )
+            expired_msg = "⚠️ The generated report has expired. Please generate it again."
+            if get_cached_pdf(st.session_state['generated_pdf_key']) is None:
+                st.warning(expired_msg)
+            else:
+                st.success("✅ Report generated successfully.")
+                # Bytes are loaded only for the run after this click, so Streamlit's in-memory
+                # copy for the download button is released on the next rerun
+                if st.button("📥 Prepare Download", use_container_width=True):
+                    pdf_bytes = read_cached_pdf(st.session_state['generated_pdf_key'])
+                    if pdf_bytes is None:
+                        st.warning(expired_msg)  # Evicted by another session since the lookup
+                    else:
+                        st.download_button(
+                            label="⬇️ Download PDF Now",
+                            data=pdf_bytes,
+                            file_name=st.session_state['generated_pdf_name'],
+                            mime="application/pdf",
+                            type="secondary",
+                            use_container_width=True
+                        )
 
 else:
     st.markdown("""